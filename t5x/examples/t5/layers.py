@@ -21,6 +21,7 @@ import functools
 import operator
 from typing import Any, Callable, Iterable, Optional, Sequence, Tuple, Union
 
+from absl import logging
 from flax import linen as nn
 from flax.linen import partitioning as nn_partitioning
 import jax
@@ -56,7 +57,8 @@ def dot_product_attention(query: Array,
                           dropout_rate: float = 0.,
                           deterministic: bool = False,
                           dtype: DType = jnp.float32,
-                          float32_logits: bool = False):
+                          float32_logits: bool = False,
+                          query_chunk_size: Optional[int] = None):
   """Computes dot-product attention given query, key, and value.
 
   This is the core function for applying attention based on
@@ -79,6 +81,12 @@ def dot_product_attention(query: Array,
     dtype: the dtype of the computation (default: float32)
     float32_logits: bool, if True then compute logits in float32 to avoid
       numerical issues with bfloat16.
+    query_chunk_size: if set, the queries are split into chunks of this size
+      and attention is computed one chunk at a time, so that only a `[batch,
+      num_heads, query_chunk_size, kv_length]` slice of the attention weights
+      is live at once. If the chunk size does not divide `q_length`, the
+      queries are padded to a multiple of it and the padded rows are dropped
+      from the output. The result is identical to the unchunked computation.
 
   Returns:
     Output of shape `[batch, length, num_heads, v_depth_per_head]`.
@@ -96,31 +104,165 @@ def dot_product_attention(query: Array,
     query = query.astype(jnp.float32)
     key = key.astype(jnp.float32)
 
-  # `attn_weights`: [batch, num_heads, q_length, kv_length]
-  attn_weights = jnp.einsum('bqhd,bkhd->bhqk', query, key)
-
-  # Apply attention bias: masking, dropout, proximity bias, etc.
-  if bias is not None:
-    attn_weights = attn_weights + bias.astype(attn_weights.dtype)
-
-  # Normalize the attention weights across `kv_length` dimension.
-  attn_weights = jax.nn.softmax(attn_weights).astype(dtype)
-
-  # Apply attention dropout.
+  # Attention dropout mask.
+  multiplier = None
   if not deterministic and dropout_rate > 0.:
     keep_prob = 1.0 - dropout_rate
     # T5 broadcasts along the "length" dim, but unclear which one that
     # corresponds to in positional dimensions here, assuming query dim.
-    dropout_shape = list(attn_weights.shape)
-    dropout_shape[-2] = 1
+    # [batch, num_heads, 1, kv_length]
+    dropout_shape = (query.shape[0], query.shape[-2], 1, key.shape[-3])
     keep = random.bernoulli(dropout_rng, keep_prob, dropout_shape)
-    keep = jnp.broadcast_to(keep, attn_weights.shape)
-    multiplier = (
-        keep.astype(attn_weights.dtype) / jnp.asarray(keep_prob, dtype=dtype))
-    attn_weights = attn_weights * multiplier
+    multiplier = (keep.astype(dtype) / jnp.asarray(keep_prob, dtype=dtype))
+
+  def attend(query, bias):
+    # `attn_weights`: [batch, num_heads, q_length, kv_length]
+    attn_weights = jnp.einsum('bqhd,bkhd->bhqk', query, key)
+
+    # Apply attention bias: masking, dropout, proximity bias, etc.
+    if bias is not None:
+      attn_weights = attn_weights + bias.astype(attn_weights.dtype)
+
+    # Normalize the attention weights across `kv_length` dimension.
+    attn_weights = jax.nn.softmax(attn_weights).astype(dtype)
+
+    # Apply attention dropout.
+    if multiplier is not None:
+      attn_weights = attn_weights * multiplier
+
+    # Take the linear combination of `value`.
+    return jnp.einsum('bhqk,bkhd->bqhd', attn_weights, value)
+
+  q_length = query.shape[-3]
+  if query_chunk_size is None or query_chunk_size >= q_length:
+    return attend(query, bias)
+
+  num_chunks = -(-q_length // query_chunk_size)
+  padding = num_chunks * query_chunk_size - q_length
+
+  # [batch, q_length, ...] -> [num_chunks, batch, query_chunk_size, ...]
+  def split_queries(x, axis):
+    if padding:
+      x = jnp.pad(x, [(0, padding) if i == axis else (0, 0)
+                      for i in range(x.ndim)])
+    x = jnp.reshape(
+        x, x.shape[:axis] + (num_chunks, query_chunk_size) + x.shape[axis + 1:])
+    return jnp.moveaxis(x, axis, 0)
+
+  query_chunks = split_queries(query, query.ndim - 3)
+  # The bias is only split if it is not broadcast along the query axis.
+  chunk_bias = bias is not None and bias.shape[-2] != 1
+  bias_chunks = split_queries(bias, bias.ndim - 2) if chunk_bias else None
+
+  # Rematerialize each chunk in the backward pass so that the attention weights
+  # of all chunks are not stored at once.
+  @jax.checkpoint
+  def attend_chunk(chunk):
+    query_chunk, bias_chunk = chunk
+    return attend(query_chunk, bias_chunk if chunk_bias else bias)
+
+  # [num_chunks, batch, query_chunk_size, num_heads, v_depth_per_head]
+  out = lax.map(attend_chunk, (query_chunks, bias_chunks))
+  out = jnp.moveaxis(out, 0, 1)
+  out = jnp.reshape(out, out.shape[:1] + (-1,) + out.shape[3:])
+  return out[:, :q_length]
+
+
+# Operand dtypes accepted by the cuDNN fused attention kernel.
+_FUSED_ATTENTION_DTYPES = (jnp.dtype(jnp.bfloat16), jnp.dtype(jnp.float16))
+# Largest head dimension accepted by the cuDNN fused attention kernel.
+_FUSED_ATTENTION_MAX_HEAD_DIM = 128
+
+
+def fused_attention_supported(query: Array, key: Array, value: Array) -> bool:
+  """Returns whether the cuDNN fused attention kernel accepts these operands.
+
+  The kernel requires bfloat16 or float16 operands of a single dtype, and head
+  dimensions that are multiples of 8 and at most 128. Single query steps (e.g.
+  autoregressive decoding) are excluded as well: cuDNN does not accept all of
+  their bias layouts, and a single query row has no logits worth fusing.
+
+  Args:
+    query: queries of shape `[batch, q_length, num_heads, qk_depth_per_head]`.
+    key: keys of shape `[batch, kv_length, num_heads, qk_depth_per_head]`.
+    value: values of shape `[batch, kv_length, num_heads, v_depth_per_head]`.
+
+  Returns:
+    Whether `fused_dot_product_attention` can be used for these operands.
+  """
+  dtypes = {jnp.dtype(x.dtype) for x in (query, key, value)}
+  if len(dtypes) != 1 or dtypes.pop() not in _FUSED_ATTENTION_DTYPES:
+    return False
+  if query.shape[-3] == 1:
+    return False
+  head_dims = (query.shape[-1], value.shape[-1])
+  return all(d % 8 == 0 and d <= _FUSED_ATTENTION_MAX_HEAD_DIM
+             for d in head_dims)
+
+
+def fused_dot_product_attention(query: Array,
+                                key: Array,
+                                value: Array,
+                                bias: Optional[Array] = None,
+                                mask: Optional[Array] = None,
+                                dtype: DType = jnp.float32):
+  """Computes dot-product attention with the cuDNN fused attention kernel.
+
+  This is a drop-in replacement for `dot_product_attention` without attention
+  dropout. It calls `jax.nn.dot_product_attention` with
+  `implementation='cudnn'`, which fuses QK^T -> softmax -> V into a flash
+  attention kernel that never materializes the `[batch, num_heads, q_length,
+  kv_length]` logits. The kernel keeps the softmax statistics in float32. It
+  is only available on GPUs, and only for operands accepted by
+  `fused_attention_supported`.
+
+  Args:
+    query: queries for calculating attention with shape of `[batch, q_length,
+      num_heads, qk_depth_per_head]`.
+    key: keys for calculating attention with shape of `[batch, kv_length,
+      num_heads, qk_depth_per_head]`.
+    value: values to be used in attention with shape of `[batch, kv_length,
+      num_heads, v_depth_per_head]`.
+    bias: bias for the attention weights. This should be broadcastable to the
+      shape `[batch, num_heads, q_length, kv_length]`.
+    mask: attention mask broadcastable to the shape `[batch, num_heads,
+      q_length, kv_length]`. Positions with a zero/False mask are not attended.
+    dtype: the dtype of the computation (default: float32)
+
+  Returns:
+    Output of shape `[batch, length, num_heads, v_depth_per_head]`.
+
+  Raises:
+    ValueError: if the operands are not supported by the fused kernel.
+  """
+  if not fused_attention_supported(query, key, value):
+    raise ValueError(
+        'Fused attention requires bfloat16 or float16 operands of one dtype, '
+        'more than one query and head dims that are multiples of 8 up to %d; '
+        'got query %s%s, key %s%s and value %s%s.' %
+        (_FUSED_ATTENTION_MAX_HEAD_DIM, query.dtype, query.shape, key.dtype,
+         key.shape, value.dtype, value.shape))
+  if bias is not None:
+    bias = bias.astype(query.dtype)
+  if mask is not None:
+    mask = mask.astype(jnp.bool_)
+
+  # NOTE: T5 folds the 1/sqrt(depth) scaling into the query initializer.
+  x = jax.nn.dot_product_attention(
+      query,
+      key,
+      value,
+      bias=bias,
+      mask=mask,
+      scale=1.0,
+      implementation='cudnn')
+  return x.astype(dtype)
 
-  # Take the linear combination of `value`.
-  return jnp.einsum('bhqk,bkhd->bqhd', attn_weights, value)
+
+def fused_attention_available() -> bool:
+  """Returns whether `fused_dot_product_attention` can run on this backend."""
+  return (hasattr(jax.nn, 'dot_product_attention') and
+          jax.default_backend() == 'gpu')
 
 
 dynamic_vector_slice_in_dim = jax.vmap(
@@ -139,6 +281,22 @@ class MultiHeadDotProductAttention(nn.Module):
       kernel_init: initializer for the kernel of the Dense layers.
       float32_logits: bool, if True then compute logits in float32 to avoid
         numerical issues with bfloat16.
+      fused_attention: bool, if True then use the cuDNN fused attention kernel
+        on GPUs whenever attention dropout is inactive, `decode` is False and
+        `fused_attention_supported` accepts the projections. Otherwise the
+        unfused attention is used, with a warning if the kernel is not
+        available at all. Cannot be combined with `float32_logits`.
+      max_attention_chunk_mb: if set, attention is computed over chunks of the
+        queries whenever the attention logits would exceed this many megabytes.
+        The fused kernel never materializes the logits, so the budget only
+        applies to the unfused attention.
+      fp8: whether to compute the projections with FP8 operands.
+      fused_qkv: whether to compute the query, key and value projections with a
+        single `qkv` matmul for self-attention (i.e. `inputs_kv is inputs_q`),
+        or the key and value projections with a single `kv` matmul otherwise.
+      cross_attention: whether `inputs_kv` is fixed during decoding (e.g. the
+        encoder outputs). If True, `decode` caches the projected keys and values
+        of `inputs_kv` instead of building an autoregressive cache.
   """
 
   num_heads: int
@@ -148,6 +306,26 @@ class MultiHeadDotProductAttention(nn.Module):
   kernel_init: Initializer = nn.initializers.variance_scaling(
       1.0, 'fan_in', 'normal')
   float32_logits: bool = False  # computes logits in float32 for stability.
+  fused_attention: bool = False
+  max_attention_chunk_mb: Optional[float] = None
+  fp8: bool = False
+  fused_qkv: bool = False
+  cross_attention: bool = False
+
+  def _query_chunk_size(self, query: Array, key: Array) -> Optional[int]:
+    """Returns the query chunk size keeping logits under the memory budget."""
+    if self.max_attention_chunk_mb is None:
+      return None
+    batch, q_length, num_heads, _ = query.shape
+    kv_length = key.shape[-3]
+    logits_dtype = jnp.float32 if self.float32_logits else query.dtype
+    # Bytes of the attention logits per query position.
+    row_bytes = batch * num_heads * kv_length * jnp.dtype(logits_dtype).itemsize
+    if q_length * row_bytes <= self.max_attention_chunk_mb * 1e6:
+      return None
+    # `dot_product_attention` pads the queries if this does not divide the
+    # query length.
+    return max(1, int(self.max_attention_chunk_mb * 1e6 // row_bytes))
 
   @nn.compact
   def __call__(self,
@@ -175,6 +353,11 @@ class MultiHeadDotProductAttention(nn.Module):
     incremental decoding stage, query, key and value all have the shape [batch,
     1, qkv_features] corresponding to a single step.
 
+    With `cross_attention`, `inputs_kv` keeps its full shape [batch, kv_length,
+    kv_features] while decoding. Its keys and values are projected on the first
+    decoding step only, and 'cached_encoded_key' and 'cached_encoded_value'
+    hold them for the remaining steps.
+
     Args:
       inputs_q: input queries of shape `[batch, q_length, q_features]`.
       inputs_kv: key/values of shape `[batch, kv_length, kv_features]`.
@@ -191,7 +374,8 @@ class MultiHeadDotProductAttention(nn.Module):
         axis=-1,
         features=(self.num_heads, self.head_dim),
         kernel_axes=('embed', 'joined_kv'),
-        dtype=self.dtype)
+        dtype=self.dtype,
+        fp8=self.fp8)
 
     # NOTE: T5 does not explicitly rescale the attention logits by
     #       1/sqrt(depth_kq)!  This is folded into the initializers of the
@@ -201,15 +385,70 @@ class MultiHeadDotProductAttention(nn.Module):
 
     # Project inputs_q to multi-headed q/k/v
     # dimensions are then [batch, length, num_heads, head_dim]
-    query = projection(kernel_init=query_init, name='query')(inputs_q)
-    key = projection(kernel_init=self.kernel_init, name='key')(inputs_kv)
-    value = projection(kernel_init=self.kernel_init, name='value')(inputs_kv)
+    if self.fused_qkv and inputs_kv is inputs_q:
+      # Self-attention: one matmul reading the inputs once.
+      # [batch, length, 3, num_heads, head_dim]
+      qkv = projection(
+          features=(3, self.num_heads, self.head_dim),
+          kernel_init=stacked_kernel_init(self.kernel_init,
+                                          (1. / depth_scaling, 1., 1.)),
+          kernel_axes=('embed', 'stack', 'joined_kv'),
+          num_stacked_features=1,
+          name='qkv')(
+              inputs_q)
+      query, key, value = (qkv[..., i, :, :] for i in range(3))
+    else:
+      query = projection(kernel_init=query_init, name='query')(inputs_q)
+
+      def project_kv(unused_mdl, inputs_kv):
+        if self.fused_qkv:
+          # Keys and values share the same inputs.
+          # [batch, length, 2, num_heads, head_dim]
+          kv = projection(
+              features=(2, self.num_heads, self.head_dim),
+              kernel_init=stacked_kernel_init(self.kernel_init, (1., 1.)),
+              kernel_axes=('embed', 'stack', 'joined_kv'),
+              num_stacked_features=1,
+              name='kv')(
+                  inputs_kv)
+          return kv[..., 0, :, :], kv[..., 1, :, :]
+        key = projection(kernel_init=self.kernel_init, name='key')(inputs_kv)
+        value = projection(
+            kernel_init=self.kernel_init, name='value')(
+                inputs_kv)
+        return key, value
+
+      if decode and self.cross_attention:
+        # `inputs_kv` stays the same at every decoding step, so its keys and
+        # values are only projected on the first step and then read from the
+        # cache. As for the self-attention cache below, the cache
+        # initialization call only creates zero-filled variables.
+        is_initialized = self.has_variable('cache', 'cached_encoded_key')
+        kv_shape = inputs_kv.shape[:-1] + (self.num_heads, self.head_dim)
+        cached_key = self.variable('cache', 'cached_encoded_key', jnp.zeros,
+                                   kv_shape, self.dtype)
+        cached_value = self.variable('cache', 'cached_encoded_value',
+                                     jnp.zeros, kv_shape, self.dtype)
+        cache_index = self.variable('cache', 'cache_index',
+                                    lambda: jnp.array(0, dtype=jnp.int32))
+        if is_initialized:
+          cached = (cached_key.value, cached_value.value)
+          key, value = nn.cond(cache_index.value == 0, project_kv,
+                               lambda unused_mdl, unused_kv: cached, self,
+                               inputs_kv)
+          cached_key.value = key
+          cached_value.value = value
+          cache_index.value = cache_index.value + 1
+        else:
+          key, value = project_kv(self, inputs_kv)
+      else:
+        key, value = project_kv(self, inputs_kv)
 
     query = with_sharding_constraint(query, ('batch', 'length', 'heads', 'kv'))
     key = with_sharding_constraint(key, ('batch', 'length', 'heads', 'kv'))
     value = with_sharding_constraint(value, ('batch', 'length', 'heads', 'kv'))
 
-    if decode:
+    if decode and not self.cross_attention:
       # Detect if we're initializing by absence of existing cache data.
       is_initialized = self.has_variable('cache', 'cached_key')
       # The key and value have dimension [batch, length, num_heads, head_dim],
@@ -268,7 +507,8 @@ class MultiHeadDotProductAttention(nn.Module):
                 # query length is 1 because during decoding we deal with one
                 # index.
                 # The same mask is applied to all batch elements and heads.
-                (batch, 1, 1, length)))
+                (batch, 1, 1, length)),
+            dtype=jnp.bool_)
 
         # Grab the correct relative attention bias during decoding. This is
         # only required during single step decoding.
@@ -279,35 +519,55 @@ class MultiHeadDotProductAttention(nn.Module):
           bias = dynamic_vector_slice_in_dim(
               jnp.squeeze(bias, axis=0), jnp.reshape(cur_index, (-1)), 1, -2)
 
-    # Convert the boolean attention mask to an attention bias.
-    if mask is not None:
-      # attention mask in the form of attention bias
-      attention_bias = lax.select(
-          mask > 0,
-          jnp.full(mask.shape, 0.).astype(self.dtype),
-          jnp.full(mask.shape, -1e10).astype(self.dtype))
-    else:
-      attention_bias = None
-
-    # Add provided bias term (e.g. relative position embedding).
-    if bias is not None:
-      attention_bias = combine_biases(attention_bias, bias)
-
     dropout_rng = None
     if not deterministic and self.dropout_rate > 0.:
       dropout_rng = self.make_rng('dropout')
 
     # Apply attention.
-    x = dot_product_attention(
-        query,
-        key,
-        value,
-        bias=attention_bias,
-        dropout_rng=dropout_rng,
-        dropout_rate=self.dropout_rate,
-        deterministic=deterministic,
-        dtype=self.dtype,
-        float32_logits=self.float32_logits)
+    if self.fused_attention and self.float32_logits:
+      raise ValueError('`fused_attention` cannot be combined with '
+                       '`float32_logits`: the fused kernel only takes bfloat16 '
+                       'or float16 operands.')
+    if self.fused_attention and not fused_attention_available():
+      logging.log_first_n(
+          logging.WARNING,
+          '`fused_attention` is set, but the cuDNN fused attention kernel is '
+          'not available with this jax version and backend. Using the unfused '
+          'attention instead.', 1)
+    if (self.fused_attention and not decode and dropout_rng is None and
+        fused_attention_supported(query, key, value) and
+        fused_attention_available()):
+      # The fused kernel does not support attention dropout or the shapes of
+      # single step decoding, so these fall back to the unfused path below.
+      # The kernel consumes the boolean mask directly.
+      x = fused_dot_product_attention(
+          query, key, value, bias=bias, mask=mask, dtype=self.dtype)
+    else:
+      # Convert the boolean attention mask to an attention bias.
+      if mask is not None:
+        # attention mask in the form of attention bias
+        attention_bias = lax.select(
+            mask > 0,
+            jnp.full(mask.shape, 0.).astype(self.dtype),
+            jnp.full(mask.shape, -1e10).astype(self.dtype))
+      else:
+        attention_bias = None
+
+      # Add provided bias term (e.g. relative position embedding).
+      if bias is not None:
+        attention_bias = combine_biases(attention_bias, bias)
+
+      x = dot_product_attention(
+          query,
+          key,
+          value,
+          bias=attention_bias,
+          dropout_rng=dropout_rng,
+          dropout_rate=self.dropout_rate,
+          deterministic=deterministic,
+          dtype=self.dtype,
+          float32_logits=self.float32_logits,
+          query_chunk_size=self._query_chunk_size(query, key))
 
     # Back to the original inputs dimensions.
     out = DenseGeneral(
@@ -316,6 +576,7 @@ class MultiHeadDotProductAttention(nn.Module):
         kernel_init=self.kernel_init,
         kernel_axes=('joined_kv', 'embed'),
         dtype=self.dtype,
+        fp8=self.fp8,
         name='out')(
             x)
     return out
@@ -333,6 +594,123 @@ def _canonicalize_tuple(x):
     return (x,)
 
 
+# ------------------------------------------------------------------------------
+# FP8 matmuls.
+# ------------------------------------------------------------------------------
+def fp8_supported() -> bool:
+  """Returns whether the default device has FP8 tensor cores (Ada/Hopper)."""
+  device = jax.devices()[0]
+  compute_capability = getattr(device, 'compute_capability', None)
+  return (device.platform == 'gpu' and compute_capability is not None and
+          float(compute_capability) >= 8.9)
+
+
+def _fp8_quantize_dequantize(x: Array, q_dtype: DType) -> Array:
+  """Rounds `x` to `q_dtype` using a per-tensor scale and casts it back.
+
+  XLA pattern-matches the dequantized operands of a dot into an FP8 GEMM with
+  the scales applied by the GEMM itself. The pattern only matches a direct
+  `convert(q) * scale` in the operand dtype, so the dequantization must not go
+  through float32.
+
+  Args:
+    x: array to round.
+    q_dtype: FP8 dtype to round to.
+
+  Returns:
+    The rounded array in the dtype of `x`.
+  """
+  dtype_max = jnp.finfo(q_dtype).max.astype(jnp.float32)
+  amax = jnp.max(jnp.abs(x)).astype(jnp.float32)
+  scale = lax.stop_gradient(
+      jnp.where(amax > 0., amax / dtype_max, jnp.ones_like(amax)))
+  scale = scale.astype(x.dtype)
+  q = jnp.clip(x / scale, -dtype_max.astype(x.dtype),
+               dtype_max.astype(x.dtype)).astype(q_dtype)
+  return q.astype(x.dtype) * scale
+
+
+@jax.custom_vjp
+def _fp8_in_qdq(x: Array) -> Array:
+  """Rounds forward operands to E4M3 with a straight-through gradient."""
+  return _fp8_quantize_dequantize(x, jnp.float8_e4m3fn)
+
+
+def _fp8_in_qdq_fwd(x):
+  return _fp8_in_qdq(x), None
+
+
+def _fp8_in_qdq_bwd(_, g):
+  return (g,)
+
+
+_fp8_in_qdq.defvjp(_fp8_in_qdq_fwd, _fp8_in_qdq_bwd)
+
+
+@jax.custom_vjp
+def _fp8_out_qdq(x: Array) -> Array:
+  """Identity whose incoming gradient is rounded to E5M2."""
+  return x
+
+
+def _fp8_out_qdq_fwd(x):
+  return x, None
+
+
+def _fp8_out_qdq_bwd(_, g):
+  return (_fp8_quantize_dequantize(g, jnp.float8_e5m2),)
+
+
+_fp8_out_qdq.defvjp(_fp8_out_qdq_fwd, _fp8_out_qdq_bwd)
+
+
+def fp8_dot_general(lhs: Array, rhs: Array, dimension_numbers) -> Array:
+  """`lax.dot_general` with operands in E4M3 and gradients in E5M2 (HYBRID).
+
+  Scales are computed from the current amax of each tensor, so no scaling
+  state has to be carried across training steps.
+
+  Args:
+    lhs: left-hand side operand.
+    rhs: right-hand side operand.
+    dimension_numbers: as in `lax.dot_general`.
+
+  Returns:
+    The result of the dot product in the dtype of the operands.
+  """
+  return _fp8_out_qdq(
+      lax.dot_general(
+          _fp8_in_qdq(lhs), _fp8_in_qdq(rhs), dimension_numbers))
+
+
+def stacked_kernel_init(kernel_init: Initializer,
+                        scales: Sequence[float]) -> Initializer:
+  """Initializes a stacked `[in, stack, out]` kernel one slice at a time.
+
+  Each `[in, out]` slice is initialized by `kernel_init` as if it were a
+  separate kernel, so that fan-in based initializers are not affected by the
+  stack axis, and is then multiplied by the corresponding entry of `scales`.
+
+  Args:
+    kernel_init: initializer for a single `[in, out]` kernel.
+    scales: per-slice multipliers, one for each entry of the stack axis.
+
+  Returns:
+    An initializer for the stacked kernel.
+  """
+
+  def init(rng, shape, dtype=jnp.float32):
+    assert shape[1] == len(scales), (shape, scales)
+    slice_shape = (shape[0], shape[2])
+    kernels = [
+        kernel_init(r, slice_shape, dtype) * scale
+        for r, scale in zip(random.split(rng, len(scales)), scales)
+    ]
+    return jnp.stack(kernels, axis=1)
+
+  return init
+
+
 # ------------------------------------------------------------------------------
 # DenseGeneral for attention layers.
 # ------------------------------------------------------------------------------
@@ -344,6 +722,12 @@ class DenseGeneral(nn.Module):
       axis: tuple with axes to apply the transformation on.
       dtype: the dtype of the computation (default: float32).
       kernel_init: initializer function for the weight matrix.
+      fp8: whether to compute the matmul with FP8 operands.
+      preferred_element_type: if set, the dtype the matmul accumulates into and
+        returns, e.g. float32 outputs from bfloat16 operands.
+      num_stacked_features: number of leading `features` dims that are kept as
+        separate kernel dims instead of being flattened with the remaining
+        features, e.g. the q/k/v axis of a fused projection.
   """
   features: Union[Iterable[int], int]
   axis: Union[Iterable[int], int] = -1
@@ -351,6 +735,9 @@ class DenseGeneral(nn.Module):
   kernel_init: Initializer = nn.initializers.variance_scaling(
       1.0, 'fan_in', 'truncated_normal')
   kernel_axes: Tuple[str, ...] = ()
+  fp8: bool = False
+  preferred_element_type: Optional[DType] = None
+  num_stacked_features: int = 0
 
   @nn.compact
   def __call__(self, inputs: Array) -> Array:
@@ -369,8 +756,10 @@ class DenseGeneral(nn.Module):
     axis = _normalize_axes(axis, inputs.ndim)
 
     kernel_shape = tuple([inputs.shape[ax] for ax in axis]) + features
-    kernel_param_shape = (np.prod([inputs.shape[ax] for ax in axis]),
-                          np.prod(features))
+    num_stacked = self.num_stacked_features
+    kernel_param_shape = ((np.prod([inputs.shape[ax] for ax in axis]),) +
+                          features[:num_stacked] +
+                          (np.prod(features[num_stacked:]),))
     kernel = param_with_axes(
         'kernel',
         self.kernel_init,
@@ -381,7 +770,14 @@ class DenseGeneral(nn.Module):
     kernel = jnp.reshape(kernel, kernel_shape)
 
     contract_ind = tuple(range(0, len(axis)))
-    return lax.dot_general(inputs, kernel, ((axis, contract_ind), ((), ())))
+    dimension_numbers = ((axis, contract_ind), ((), ()))
+    if self.fp8:
+      return fp8_dot_general(inputs, kernel, dimension_numbers)
+    return lax.dot_general(
+        inputs,
+        kernel,
+        dimension_numbers,
+        preferred_element_type=self.preferred_element_type)
 
 
 def _convert_to_activation_function(
@@ -409,6 +805,13 @@ class MlpBlock(nn.Module):
     deterministic: Whether the dropout layers should be deterministic.
     intermediate_dropout_rate: Dropout rate used after the intermediate layers.
     dtype: Type for the dense layer.
+    fp8: Whether to compute the dense layers with FP8 operands.
+    fused_wi: Whether to compute the input projections of all `activations`
+      with a single `wi` matmul, which reads the inputs once and runs one
+      larger GEMM instead of one per activation. The intermediate activations
+      are still materialized before `wo`. Only affects gated MLPs, e.g.
+      ('gelu', 'linear'), and changes the parameter layout from `wi_{idx}` to
+      `wi`, whose projections are stacked along a 'stack' axis.
   """
   intermediate_dim: int = 2048
   activations: Sequence[Union[str, Callable]] = ('relu',)
@@ -416,6 +819,8 @@ class MlpBlock(nn.Module):
       1.0, 'fan_in', 'truncated_normal')
   intermediate_dropout_rate: float = 0.1
   dtype: Any = jnp.float32
+  fp8: bool = False
+  fused_wi: bool = False
 
   @nn.compact
   def __call__(self, inputs, decode: bool = False, deterministic: bool = False):
@@ -423,17 +828,37 @@ class MlpBlock(nn.Module):
     # Iterate over specified MLP input activation functions.
     # e.g. ('relu',) or ('gelu', 'linear') for gated-gelu.
     activations = []
-    for idx, act_fn in enumerate(self.activations):
-      dense_name = 'wi' if len(self.activations) == 1 else f'wi_{idx}'
+    if self.fused_wi and len(self.activations) > 1:
+      # [batch, length, len(activations), intermediate_dim]
       x = DenseGeneral(
-          self.intermediate_dim,
+          (len(self.activations), self.intermediate_dim),
           dtype=self.dtype,
-          kernel_init=self.kernel_init,
-          kernel_axes=('embed', 'mlp'),
-          name=dense_name)(
+          kernel_init=stacked_kernel_init(self.kernel_init,
+                                          (1.,) * len(self.activations)),
+          # Like the fused attention projections, the stacked axis is a batch
+          # dimension for Adafactor, so each projection keeps its own factored
+          # second moments as with separate `wi_{idx}` kernels.
+          kernel_axes=('embed', 'stack', 'mlp'),
+          fp8=self.fp8,
+          num_stacked_features=1,
+          name='wi')(
               inputs)
-      x = _convert_to_activation_function(act_fn)(x)
-      activations.append(x)
+      for idx, act_fn in enumerate(self.activations):
+        activations.append(
+            _convert_to_activation_function(act_fn)(x[..., idx, :]))
+    else:
+      for idx, act_fn in enumerate(self.activations):
+        dense_name = 'wi' if len(self.activations) == 1 else f'wi_{idx}'
+        x = DenseGeneral(
+            self.intermediate_dim,
+            dtype=self.dtype,
+            kernel_init=self.kernel_init,
+            kernel_axes=('embed', 'mlp'),
+            fp8=self.fp8,
+            name=dense_name)(
+                inputs)
+        x = _convert_to_activation_function(act_fn)(x)
+        activations.append(x)
 
     # Take elementwise product of above intermediate activations.
     x = functools.reduce(operator.mul, activations)
@@ -447,6 +872,7 @@ class MlpBlock(nn.Module):
         dtype=self.dtype,
         kernel_init=self.kernel_init,
         kernel_axes=('mlp', 'embed'),
+        fp8=self.fp8,
         name='wo')(
             x)
     return output
@@ -461,7 +887,10 @@ class Embed(nn.Module):
     dtype: the dtype of the embedding vectors (default: float32).
     embedding_init: embedding initializer.
     one_hot: performs the gather with a one-hot contraction rather than a true
-      gather. This is currently needed for SPMD partitioning.
+      gather. This is needed for SPMD partitioning when the embedding table is
+      sharded along 'vocab' (e.g. by `standard_logical_axis_rules`). A true
+      gather avoids the [..., num_embeddings] one-hot array and is cheaper when
+      the table is replicated.
   """
   num_embeddings: int
   features: int
@@ -502,12 +931,16 @@ class Embed(nn.Module):
       output = with_sharding_constraint(output, ('batch', 'length', 'embed'))
     return output
 
-  def attend(self, query: Array) -> Array:
+  def attend(self,
+             query: Array,
+             preferred_element_type: Optional[DType] = None) -> Array:
     """Attend over the embedding using a query array.
 
     Args:
       query: array with last dimension equal the feature depth `features` of the
         embedding.
+      preferred_element_type: if set, the dtype the matmul accumulates into and
+        returns.
 
     Returns:
       An array with final dim `num_embeddings` corresponding to the batched
@@ -516,7 +949,10 @@ class Embed(nn.Module):
       in NLP models.
     """
     dtype = self.attend_dtype if self.attend_dtype is not None else self.dtype
-    return jnp.dot(query, jnp.asarray(self.embedding, dtype).T)
+    return jnp.dot(
+        query,
+        jnp.asarray(self.embedding, dtype).T,
+        preferred_element_type=preferred_element_type)
 
 
 class RelativePositionBiases(nn.Module):
@@ -28,6 +28,7 @@ from jax import random
 from jax.nn import initializers
 import jax.numpy as jnp
 import numpy as np
+from t5x import adafactor
 from t5x.examples.t5 import layers
 
 # Parse absl flags test_srcdir and test_tmpdir.
@@ -329,6 +330,42 @@ class AttentionTest(parameterized.TestCase):
     y_expected = np.einsum('bqhd,hdf->bqf', combined_value, out_kernel)
     np.testing.assert_allclose(y, y_expected, rtol=1e-5, atol=1e-5)
 
+  @parameterized.parameters({'self_attention': True},
+                            {'self_attention': False})
+  def test_multihead_dot_product_attention_fused_qkv(self, self_attention):
+    # b: batch, f: emb_dim, q: q_len, k: kv_len, h: num_head, d: head_dim
+    b, q, h, d, f = 2, 3, 4, 5, 6
+    args = SelfAttentionArgs(num_heads=h, head_dim=d, dropout_rate=0)
+
+    np.random.seed(0)
+    inputs_q = jnp.asarray(np.random.randn(b, q, f))
+    inputs_kv = inputs_q if self_attention else jnp.asarray(
+        np.random.randn(b, q, f))
+
+    module = layers.MultiHeadDotProductAttention(**args.init_args())
+    params = module.init(random.PRNGKey(0), inputs_q, inputs_kv)['params']
+    fused_module = layers.MultiHeadDotProductAttention(
+        fused_qkv=True, **args.init_args())
+    fused_params = fused_module.init(random.PRNGKey(0), inputs_q,
+                                     inputs_kv)['params']
+
+    # The fused kernels are the per-projection kernels stacked along axis 1.
+    stack = lambda *names: {
+        'kernel': jnp.stack([params[n]['kernel'] for n in names], axis=1)
+    }
+    if self_attention:
+      self.assertEqual(set(fused_params), {'qkv', 'out'})
+      fused_params = {'qkv': stack('query', 'key', 'value')}
+    else:
+      self.assertEqual(set(fused_params), {'query', 'kv', 'out'})
+      fused_params = {'query': params['query'], 'kv': stack('key', 'value')}
+    fused_params['out'] = params['out']
+
+    y = module.apply({'params': params}, inputs_q, inputs_kv)
+    fused_y = fused_module.apply({'params': freeze(fused_params)}, inputs_q,
+                                 inputs_kv)
+    np.testing.assert_allclose(fused_y, y, rtol=1e-5, atol=1e-5)
+
   def test_multihead_dot_product_attention_caching(self):
     # b: batch, f: qkv_features, k: kv_len, h: num_head, d: head_dim
     b, h, d, k = 2, 3, 4, 5
@@ -372,6 +409,215 @@ class AttentionTest(parameterized.TestCase):
     for name, array in cache.items():
       np.testing.assert_allclose(array, updated_cache[name])
 
+  @parameterized.parameters({'fused_qkv': False}, {'fused_qkv': True})
+  def test_multihead_dot_product_attention_cross_attention_caching(
+      self, fused_qkv):
+    # b: batch, q: q_len, k: kv_len, f: features, h: num_head, d: head_dim
+    b, q, k, f, h, d = 2, 3, 5, 6, 2, 4
+    rngs = random.split(random.PRNGKey(0), 3)
+    inputs_q = random.normal(rngs[0], (b, q, f))
+    inputs_kv = random.normal(rngs[1], (b, k, f))
+
+    module = layers.MultiHeadDotProductAttention(
+        num_heads=h, head_dim=d, fused_qkv=fused_qkv, cross_attention=True)
+    params = module.init(
+        rngs[2], inputs_q, inputs_kv, deterministic=True)['params']
+    expected = module.apply(
+        {'params': params}, inputs_q, inputs_kv, deterministic=True)
+
+    _, variables = module.apply({'params': params},
+                                inputs_q,
+                                jnp.ones_like(inputs_kv),
+                                decode=True,
+                                deterministic=True,
+                                mutable=['cache'])
+    cache = variables['cache']
+    for i in range(q):
+      # Only the first step should project `inputs_kv`; later steps must use
+      # the cached keys and values.
+      step_kv = inputs_kv if i == 0 else jnp.zeros_like(inputs_kv)
+      out, variables = module.apply({'params': params, 'cache': cache},
+                                    inputs_q[:, i:i + 1],
+                                    step_kv,
+                                    decode=True,
+                                    deterministic=True,
+                                    mutable=['cache'])
+      cache = variables['cache']
+      np.testing.assert_allclose(
+          out, expected[:, i:i + 1], rtol=1e-5, atol=1e-5)
+    self.assertEqual(cache['cache_index'], q)
+
+  @parameterized.parameters(
+      {'deterministic': True, 'bias_q_len': 8, 'query_chunk_size': 2},
+      {'deterministic': False, 'bias_q_len': 8, 'query_chunk_size': 2},
+      {'deterministic': True, 'bias_q_len': 1, 'query_chunk_size': 2},
+      # Chunk sizes that do not divide the query length pad the queries.
+      {'deterministic': True, 'bias_q_len': 8, 'query_chunk_size': 3},
+      {'deterministic': False, 'bias_q_len': 1, 'query_chunk_size': 3},
+  )
+  def test_chunked_dot_product_attention(self, deterministic, bias_q_len,
+                                         query_chunk_size):
+    # b: batch, q: q_len, k: kv_len, h: num_head, d: head_dim
+    b, q, h, d, k = 2, 8, 3, 4, 5
+    np.random.seed(0)
+    query = np.random.randn(b, q, h, d).astype(np.float32)
+    key = np.random.randn(b, k, h, d).astype(np.float32)
+    value = np.random.randn(b, k, h, d).astype(np.float32)
+    bias = np.random.randn(1, h, bias_q_len, k).astype(np.float32)
+    args = dict(
+        bias=bias,
+        dropout_rng=random.PRNGKey(0),
+        dropout_rate=0.5,
+        deterministic=deterministic)
+    expected = layers.dot_product_attention(query, key, value, **args)
+    attn_out = layers.dot_product_attention(
+        query, key, value, query_chunk_size=query_chunk_size, **args)
+    np.testing.assert_allclose(attn_out, expected, atol=1e-6)
+
+  def test_multihead_dot_product_attention_chunk_budget(self):
+    # b: batch, q: q_len, f: features, h: num_head, d: head_dim
+    b, q, f, h, d = 2, 7, 6, 2, 4
+    inputs = random.normal(random.PRNGKey(0), (b, q, f))
+    bias = random.normal(random.PRNGKey(1), (1, h, q, q))
+    module = layers.MultiHeadDotProductAttention(num_heads=h, head_dim=d)
+    # float32 logits take b * h * q * 4 = 112 bytes per query position, so a
+    # 300 byte budget gives chunks of 2 queries, which do not divide q.
+    chunked_module = module.clone(max_attention_chunk_mb=3e-4)
+    params = module.init(
+        random.PRNGKey(2), inputs, inputs, bias=bias, deterministic=True)
+    expected = module.apply(
+        params, inputs, inputs, bias=bias, deterministic=True)
+    with mock.patch.object(
+        layers, 'dot_product_attention',
+        wraps=layers.dot_product_attention) as attention:
+      y = chunked_module.apply(
+          params, inputs, inputs, bias=bias, deterministic=True)
+    self.assertEqual(attention.call_args.kwargs['query_chunk_size'], 2)
+    np.testing.assert_allclose(y, expected, rtol=1e-5, atol=1e-5)
+
+  def test_fused_dot_product_attention(self):
+    if not layers.fused_attention_available():
+      self.skipTest('The cuDNN fused attention kernel is not available.')
+    # b: batch, f: emb_dim, q: q_len, k: kv_len, h: num_head, d: head_dim
+    b, q, h, d, k = 2, 16, 4, 64, 16
+    np.random.seed(0)
+    query = np.random.randn(b, q, h, d).astype(jnp.bfloat16)
+    key = np.random.randn(b, k, h, d).astype(jnp.bfloat16)
+    value = np.random.randn(b, k, h, d).astype(jnp.bfloat16)
+    bias = np.random.randn(b, h, q, k).astype(jnp.bfloat16)
+    attn_out = layers.fused_dot_product_attention(query, key, value, bias=bias)
+    expected = layers.dot_product_attention(
+        query, key, value, bias=bias, deterministic=True)
+    np.testing.assert_allclose(attn_out, expected, atol=2e-2)
+
+  @parameterized.parameters(
+      {'dtype': jnp.float32, 'q_len': 2, 'head_dim': 8},
+      {'dtype': jnp.bfloat16, 'q_len': 2, 'head_dim': 12},
+      {'dtype': jnp.bfloat16, 'q_len': 2, 'head_dim': 256},
+      {'dtype': jnp.bfloat16, 'q_len': 1, 'head_dim': 8},
+  )
+  def test_fused_dot_product_attention_rejects_unsupported_operands(
+      self, dtype, q_len, head_dim):
+    query = jnp.ones((1, q_len, 1, head_dim), dtype)
+    key = value = jnp.ones((1, 2, 1, head_dim), dtype)
+    self.assertFalse(layers.fused_attention_supported(query, key, value))
+    with self.assertRaisesRegex(ValueError, 'Fused attention requires'):
+      layers.fused_dot_product_attention(query, key, value)
+
+  def _mock_cudnn_attention(self, calls):
+    """Returns a stand-in for the cuDNN kernel recording its invocations."""
+
+    def mock_dot_product_attention(query, key, value, bias, mask, scale,
+                                   implementation):
+      self.assertEqual(scale, 1.0)
+      calls.append(implementation)
+      mask_bias = jnp.where(mask, 0., -1e10).astype(query.dtype)
+      return layers.dot_product_attention(
+          query,
+          key,
+          value,
+          bias=layers.combine_biases(mask_bias, bias),
+          dtype=query.dtype)
+
+    return mock.patch.object(
+        jax.nn,
+        'dot_product_attention',
+        new=mock_dot_product_attention,
+        create=True)
+
+  @parameterized.parameters(
+      {'dtype': jnp.bfloat16, 'head_dim': 8, 'expected_calls': ['cudnn']},
+      {'dtype': jnp.float32, 'head_dim': 8, 'expected_calls': []},
+      # Head dims cuDNN does not accept use the unfused attention.
+      {'dtype': jnp.bfloat16, 'head_dim': 12, 'expected_calls': []},
+  )
+  def test_multihead_dot_product_attention_fused(self, dtype, head_dim,
+                                                 expected_calls):
+    # b: batch, q: q_len, f: features, h: num_head, d: head_dim
+    b, q, f, h, d = 2, 4, 6, 2, head_dim
+    inputs = random.normal(random.PRNGKey(0), (b, q, f))
+    mask = layers.make_causal_mask(jnp.ones((b, q)), dtype=jnp.bool_)
+    bias = random.normal(random.PRNGKey(1), (1, h, q, q))
+    calls = []
+    module = layers.MultiHeadDotProductAttention(
+        num_heads=h, head_dim=d, dtype=dtype)
+    fused_module = module.clone(fused_attention=True)
+    params = module.init(
+        random.PRNGKey(2), inputs, inputs, mask, bias, deterministic=True)
+    expected = module.apply(
+        params, inputs, inputs, mask, bias, deterministic=True)
+    with mock.patch.object(layers, 'fused_attention_available', lambda: True):
+      with self._mock_cudnn_attention(calls):
+        y = fused_module.apply(
+            params, inputs, inputs, mask, bias, deterministic=True)
+    self.assertEqual(calls, expected_calls)
+    np.testing.assert_allclose(
+        y.astype(jnp.float32), expected.astype(jnp.float32), atol=1e-2)
+
+  def test_multihead_dot_product_attention_fused_skips_decode(self):
+    # b: batch, q: q_len, f: features, h: num_head, d: head_dim
+    b, q, f, h, d = 2, 4, 6, 2, 8
+    inputs = random.normal(random.PRNGKey(0), (b, q, f)).astype(jnp.bfloat16)
+    module = layers.MultiHeadDotProductAttention(
+        num_heads=h, head_dim=d, dtype=jnp.bfloat16, fused_attention=True)
+    params = module.init(
+        random.PRNGKey(1), inputs, inputs, deterministic=True)['params']
+    calls = []
+    with mock.patch.object(layers, 'fused_attention_available', lambda: True):
+      with self._mock_cudnn_attention(calls):
+        _, variables = module.apply({'params': params},
+                                    inputs,
+                                    inputs,
+                                    decode=True,
+                                    deterministic=True,
+                                    mutable=['cache'])
+        module.apply({'params': params, 'cache': variables['cache']},
+                     inputs[:, :1],
+                     inputs[:, :1],
+                     decode=True,
+                     deterministic=True,
+                     mutable=['cache'])
+    self.assertEqual(calls, [])
+
+  def test_multihead_dot_product_attention_fused_unavailable_warns(self):
+    inputs = random.normal(random.PRNGKey(0), (2, 4, 6))
+    module = layers.MultiHeadDotProductAttention(num_heads=2, head_dim=8)
+    params = module.init(random.PRNGKey(1), inputs, inputs, deterministic=True)
+    expected = module.apply(params, inputs, inputs, deterministic=True)
+    with mock.patch.object(layers, 'fused_attention_available', lambda: False):
+      with mock.patch.object(layers.logging, 'log_first_n') as log_first_n:
+        y = module.clone(fused_attention=True).apply(
+            params, inputs, inputs, deterministic=True)
+    log_first_n.assert_called_once()
+    np.testing.assert_allclose(y, expected)
+
+  def test_multihead_dot_product_attention_fused_rejects_float32_logits(self):
+    inputs = jnp.ones((1, 2, 4))
+    module = layers.MultiHeadDotProductAttention(
+        num_heads=1, head_dim=4, fused_attention=True, float32_logits=True)
+    with self.assertRaisesRegex(ValueError, 'float32_logits'):
+      module.init(random.PRNGKey(0), inputs, inputs, deterministic=True)
+
   def test_dot_product_attention(self):
     # b: batch, f: emb_dim, q: q_len, k: kv_len, h: num_head, d: head_dim
     b, q, h, d, k = 2, 3, 4, 5, 6
@@ -483,6 +729,46 @@ class DenseTest(parameterized.TestCase):
     # We transform the last two input dimensions (2, 2) to one output dimension.
     np.testing.assert_allclose(y, np.full((1, 3), 4.))
 
+  def test_dense_general_stacked_features(self):
+    rng = random.PRNGKey(0)
+    x = jnp.ones((1, 3))
+    model = layers.DenseGeneral(
+        features=(2, 4, 5),
+        kernel_init=initializers.ones,
+        num_stacked_features=1,
+    )
+    y, variables = model.init_with_output(rng, x)
+    self.assertEqual(variables['params']['kernel'].shape, (3, 2, 20))
+    self.assertEqual(y.shape, (1, 2, 4, 5))
+    np.testing.assert_allclose(y, np.full((1, 2, 4, 5), 3.))
+
+  def test_dense_general_fp8(self):
+    rng = random.PRNGKey(0)
+    # Neither the inputs nor the kernel are exactly representable in FP8.
+    x = random.normal(random.PRNGKey(1), (2, 3))
+    model = layers.DenseGeneral(features=4, fp8=True)
+    variables = model.init(rng, x)
+    kernel = variables['params']['kernel']
+
+    def round_trip(a, q_dtype):
+      scale = jnp.max(jnp.abs(a)) / jnp.finfo(q_dtype).max.astype(jnp.float32)
+      return (a / scale).astype(q_dtype).astype(jnp.float32) * scale
+
+    y = model.apply(variables, x)
+    expected = jnp.dot(
+        round_trip(x, jnp.float8_e4m3fn), round_trip(kernel, jnp.float8_e4m3fn))
+    np.testing.assert_allclose(y, expected, rtol=1e-6, atol=1e-6)
+    self.assertGreater(np.max(np.abs(y - jnp.dot(x, kernel))), 1e-3)
+
+    # Forward operands are rounded to E4M3 and incoming gradients to E5M2.
+    cotangent = random.normal(random.PRNGKey(2), (2, 4))
+    grad = jax.grad(lambda x: jnp.sum(model.apply(variables, x) * cotangent))(
+        x)
+    expected_grad = jnp.dot(
+        round_trip(cotangent, jnp.float8_e5m2),
+        round_trip(kernel, jnp.float8_e4m3fn).T)
+    np.testing.assert_allclose(grad, expected_grad, rtol=1e-6, atol=1e-6)
+
   def test_mlp_same_out_dim(self):
     module = layers.MlpBlock(
         intermediate_dim=4,
@@ -540,6 +826,39 @@ class DenseTest(parameterized.TestCase):
         rtol=1e-6,
     )
 
+  def test_mlp_fused_wi(self):
+    kwargs = dict(
+        intermediate_dim=4,
+        activations=('gelu', 'linear'),
+        intermediate_dropout_rate=0.,
+    )
+    module = layers.MlpBlock(**kwargs)
+    fused_module = layers.MlpBlock(fused_wi=True, **kwargs)
+    np.random.seed(0)
+    inputs = np.random.randn(2, 3, 5).astype(np.float32)
+    params = module.init(random.PRNGKey(0), inputs)['params']
+
+    # The stacked axis must be a batch dimension for Adafactor, so that the
+    # fused kernel is factored like the separate `wi_{idx}` kernels.
+    kernel_axes = fused_module.init(
+        random.PRNGKey(0), inputs)['params_axes']['wi']['kernel_axes']
+    self.assertEqual(kernel_axes, AxisMetadata(names=('embed', 'stack', 'mlp')))
+    self.assertEqual(adafactor.standard_logical_factor_rules()['stack'],
+                     adafactor.FactorDim.BATCH)
+
+    fused_params = {
+        'wi': {
+            'kernel':
+                jnp.stack([params['wi_0']['kernel'], params['wi_1']['kernel']],
+                          axis=1)
+        },
+        'wo': params['wo'],
+    }
+    np.testing.assert_allclose(
+        fused_module.apply({'params': freeze(fused_params)}, inputs),
+        module.apply({'params': params}, inputs),
+        rtol=1e-5)
+
 
 class RelativePositionBiasesTest(absltest.TestCase):
 
@@ -14,13 +14,19 @@
 
 """T5.1.1 Transformer model."""
 
-from typing import Any, Sequence
+from typing import Any, Optional, Sequence
 
 from flax import linen as nn
 from flax import struct
+from flax.linen import partitioning as nn_partitioning
+import jax
 import jax.numpy as jnp
 from t5x.examples.t5 import layers
 
+scan_with_axes = nn_partitioning.scan_with_axes
+remat = nn_partitioning.remat
+with_sharding_constraint = nn_partitioning.with_sharding_constraint
+
 
 @struct.dataclass
 class T5Config:
@@ -39,22 +45,85 @@ class T5Config:
   dropout_rate: float = 0.1
   # If `True`, the embedding weights are used in the decoder output layer.
   logits_via_embedding: bool = False
+  # Whether to compute the output logits matmul with float32 operands. If
+  # `False`, the operands are kept in `dtype` and only the logits are float32,
+  # which is much faster for a large vocabulary on bfloat16 tensor cores.
+  float32_logits_matmul: bool = True
+  # If `True`, token embeddings are looked up with a one-hot contraction instead
+  # of a gather. The contraction partitions cleanly when the embedding table is
+  # sharded along 'vocab', as in the standard logical axis rules. Configs that
+  # replicate the table (single device or pure data parallelism) can set this
+  # to `False` to avoid materializing a [batch, length, vocab_size] array.
+  embed_one_hot: bool = True
   # Whether to accumulate attention logits in float32 regardless of dtype.
   float32_attention_logits: bool = False
+  # Whether to use the cuDNN fused attention kernel on GPUs when attention
+  # dropout is inactive and `dtype` is bfloat16/float16. Incompatible with
+  # `float32_attention_logits`.
+  fused_attention: bool = False
+  # If set, attention is computed over query chunks whenever the attention
+  # logits of a layer would exceed this many megabytes.
+  max_attn_chunk_mb: Optional[float] = None
+  # Whether to run the attention and MLP projections in FP8. Ignored on devices
+  # without FP8 tensor cores.
+  fp8: bool = False
+  # Whether to fuse the attention input projections into a single matmul. This
+  # changes the parameter layout from `query`/`key`/`value` to `qkv` (self-
+  # attention) or `query`/`kv` (cross-attention).
+  fused_qkv: bool = False
+  # Whether to compute the gated MLP input projections with a single matmul,
+  # reading the MLP inputs once instead of once per activation. This changes
+  # the parameter layout from `wi_{idx}` to `wi`; Adafactor still factors each
+  # stacked projection separately.
+  fused_mlp_wi: bool = False
+  # Whether to scan over the layer stack instead of unrolling it. Scanned
+  # parameters are stacked along a leading 'layers' axis.
+  scan_layers: bool = False
+  # Activation checkpointing policy for each layer: 'none' or one of the
+  # `jax.checkpoint_policies` policies 'nothing_saveable', 'dots_saveable' or
+  # 'dots_with_no_batch_dims_saveable'.
+  remat_policy: str = 'none'
+
+
+def _use_fp8(config):
+  """Returns whether FP8 projections are requested and supported."""
+  return config.fp8 and layers.fp8_supported()
+
+
+# Supported values of `T5Config.remat_policy` besides 'none'. These are the
+# `jax.checkpoint_policies` that are policies themselves rather than factories
+# taking arguments.
+_REMAT_POLICIES = ('nothing_saveable', 'dots_saveable',
+                   'dots_with_no_batch_dims_saveable')
+
+
+def _maybe_remat(layer_cls, config, static_argnums):
+  """Wraps `layer_cls` in activation checkpointing per `config.remat_policy`."""
+  if config.remat_policy in (None, 'none'):
+    return layer_cls
+  if config.remat_policy not in _REMAT_POLICIES:
+    raise ValueError(f'Unknown remat_policy: {config.remat_policy}. Expected '
+                     f"'none' or one of {_REMAT_POLICIES}.")
+  policy = getattr(jax.checkpoint_policies, config.remat_policy)
+  return remat(
+      layer_cls,
+      prevent_cse=not config.scan_layers,
+      policy=policy,
+      static_argnums=static_argnums)
 
 
 class EncoderLayer(nn.Module):
   """Transformer encoder layer."""
   config: T5Config
-  relative_embedding: nn.Module
 
   @nn.compact
-  def __call__(self, inputs, encoder_mask=None, deterministic=False):
+  def __call__(self,
+               inputs,
+               encoder_mask=None,
+               deterministic=False,
+               encoder_bias=None):
     cfg = self.config
-
-    # Relative position embedding as attention biases.
-    encoder_bias = self.relative_embedding(inputs.shape[-2], inputs.shape[-2],
-                                           True)
+    fp8 = _use_fp8(cfg)
 
     # Attention block.
     assert inputs.ndim == 3
@@ -68,12 +137,17 @@ class EncoderLayer(nn.Module):
         head_dim=cfg.head_dim,
         dropout_rate=cfg.dropout_rate,
         float32_logits=cfg.float32_attention_logits,
+        fused_attention=cfg.fused_attention,
+        max_attention_chunk_mb=cfg.max_attn_chunk_mb,
+        fp8=fp8,
+        fused_qkv=cfg.fused_qkv,
         name='attention')(
             x, x, encoder_mask, encoder_bias, deterministic=deterministic)
     x = nn.Dropout(
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             x, deterministic=deterministic)
     x = x + inputs
+    x = with_sharding_constraint(x, ('batch', 'length', 'embed'))
 
     # MLP block.
     y = layers.LayerNorm(dtype=cfg.dtype, name='pre_mlp_layer_norm')(x)
@@ -83,20 +157,25 @@ class EncoderLayer(nn.Module):
         activations=cfg.mlp_activations,
         intermediate_dropout_rate=cfg.dropout_rate,
         dtype=cfg.dtype,
+        fp8=fp8,
+        fused_wi=cfg.fused_mlp_wi,
         name='mlp',
     )(y, deterministic=deterministic)
     y = nn.Dropout(
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             y, deterministic=deterministic)
     y = y + x
+    y = with_sharding_constraint(y, ('batch', 'length', 'embed'))
 
-    return y
+    if cfg.scan_layers:
+      return y, None
+    else:
+      return y
 
 
 class DecoderLayer(nn.Module):
   """Transformer decoder layer that attends to the encoder."""
   config: T5Config
-  relative_embedding: nn.Module
 
   @nn.compact
   def __call__(self,
@@ -106,12 +185,10 @@ class DecoderLayer(nn.Module):
                encoder_decoder_mask=None,
                deterministic=False,
                decode=False,
-               max_decode_length=None):
+               max_decode_length=None,
+               decoder_bias=None):
     cfg = self.config
-
-    # Relative position embedding as attention biases.
-    l = max_decode_length if decode and max_decode_length else inputs.shape[-2]
-    decoder_bias = self.relative_embedding(l, l, False)
+    fp8 = _use_fp8(cfg)
 
     # inputs: embedded inputs to the decoder with shape [batch, length, emb_dim]
     x = layers.LayerNorm(
@@ -125,6 +202,10 @@ class DecoderLayer(nn.Module):
         head_dim=cfg.head_dim,
         dropout_rate=cfg.dropout_rate,
         float32_logits=cfg.float32_attention_logits,
+        fused_attention=cfg.fused_attention,
+        max_attention_chunk_mb=cfg.max_attn_chunk_mb,
+        fp8=fp8,
+        fused_qkv=cfg.fused_qkv,
         name='self_attention')(
             x,
             x,
@@ -136,6 +217,7 @@ class DecoderLayer(nn.Module):
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             x, deterministic=deterministic)
     x = x + inputs
+    x = with_sharding_constraint(x, ('batch', 'length', 'embed'))
 
     # Encoder-Decoder block.
     y = layers.LayerNorm(
@@ -147,12 +229,22 @@ class DecoderLayer(nn.Module):
         head_dim=cfg.head_dim,
         dropout_rate=cfg.dropout_rate,
         float32_logits=cfg.float32_attention_logits,
+        fused_attention=cfg.fused_attention,
+        max_attention_chunk_mb=cfg.max_attn_chunk_mb,
+        fp8=fp8,
+        fused_qkv=cfg.fused_qkv,
+        cross_attention=True,
         name='encoder_decoder_attention')(
-            y, encoded, encoder_decoder_mask, deterministic=deterministic)
+            y,
+            encoded,
+            encoder_decoder_mask,
+            deterministic=deterministic,
+            decode=decode)
     y = nn.Dropout(
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             y, deterministic=deterministic)
     y = y + x
+    y = with_sharding_constraint(y, ('batch', 'length', 'embed'))
 
     # MLP block.
     z = layers.LayerNorm(dtype=cfg.dtype, name='pre_mlp_layer_norm')(y)
@@ -161,14 +253,20 @@ class DecoderLayer(nn.Module):
         activations=cfg.mlp_activations,
         intermediate_dropout_rate=cfg.dropout_rate,
         dtype=cfg.dtype,
+        fp8=fp8,
+        fused_wi=cfg.fused_mlp_wi,
         name='mlp',
     )(z, deterministic=deterministic)
     z = nn.Dropout(
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             z, deterministic=deterministic)
     z = z + y
+    z = with_sharding_constraint(z, ('batch', 'length', 'embed'))
 
-    return z
+    if cfg.scan_layers:
+      return z, None
+    else:
+      return z
 
 
 class Encoder(nn.Module):
@@ -197,13 +295,32 @@ class Encoder(nn.Module):
     x = nn.Dropout(
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             x, deterministic=deterministic)
-    x = x.astype(cfg.dtype)
 
-    for lyr in range(cfg.num_encoder_layers):
-      # [batch, length, emb_dim] -> [batch, length, emb_dim]
-      x = EncoderLayer(
-          config=cfg, relative_embedding=rel_emb,
-          name=f'layers_{lyr}')(x, encoder_mask, deterministic)
+    # `deterministic` is static.
+    BlockLayer = _maybe_remat(EncoderLayer, cfg, static_argnums=(2,))  # pylint: disable=invalid-name
+
+    # Relative position embedding as attention biases, shared by all layers.
+    encoder_bias = rel_emb(x.shape[-2], x.shape[-2], True)
+
+    if cfg.scan_layers:
+      x, _ = scan_with_axes(
+          BlockLayer,
+          variable_axes={'params': 0},
+          split_rngs={
+              'params': True,
+              'dropout': True
+          },
+          in_axes=(nn.broadcast, nn.broadcast, nn.broadcast),
+          length=cfg.num_encoder_layers,
+          axis_name='layers')(
+              config=cfg, name='layers')(x, encoder_mask, deterministic,
+                                         encoder_bias)
+    else:
+      for lyr in range(cfg.num_encoder_layers):
+        # [batch, length, emb_dim] -> [batch, length, emb_dim]
+        x = BlockLayer(
+            config=cfg, name=f'layers_{lyr}')(x, encoder_mask, deterministic,
+                                              encoder_bias)
 
     x = layers.LayerNorm(dtype=cfg.dtype, name='encoder_norm')(x)
     return nn.Dropout(rate=cfg.dropout_rate)(x, deterministic=deterministic)
@@ -240,19 +357,41 @@ class Decoder(nn.Module):
     y = nn.Dropout(
         rate=cfg.dropout_rate, broadcast_dims=(-2,))(
             y, deterministic=deterministic)
-    y = y.astype(cfg.dtype)
-
-    for lyr in range(cfg.num_decoder_layers):
-      # [batch, length, emb_dim] -> [batch, length, emb_dim]
-      y = DecoderLayer(
-          config=cfg, relative_embedding=rel_emb, name=f'layers_{lyr}')(
-              y,
-              encoded,
-              decoder_mask=decoder_mask,
-              encoder_decoder_mask=encoder_decoder_mask,
-              deterministic=deterministic,
-              decode=decode,
-              max_decode_length=max_decode_length)
+
+    # `deterministic`, `decode` and `max_decode_length` are static.
+    BlockLayer = _maybe_remat(DecoderLayer, cfg, static_argnums=(4, 5, 6))  # pylint: disable=invalid-name
+
+    # Relative position embedding as attention biases, shared by all layers.
+    l = max_decode_length if decode and max_decode_length else y.shape[-2]
+    decoder_bias = rel_emb(l, l, False)
+
+    if cfg.scan_layers:
+      y, _ = scan_with_axes(
+          BlockLayer,
+          variable_axes={
+              'params': 0,
+              'cache': 0
+          },
+          split_rngs={
+              'params': True,
+              'dropout': True
+          },
+          in_axes=(nn.broadcast, nn.broadcast, nn.broadcast, nn.broadcast,
+                   nn.broadcast, nn.broadcast, nn.broadcast),
+          length=cfg.num_decoder_layers,
+          axis_name='layers')(
+              config=cfg,
+              name='layers')(y, encoded, decoder_mask, encoder_decoder_mask,
+                             deterministic, decode, max_decode_length,
+                             decoder_bias)
+    else:
+      for lyr in range(cfg.num_decoder_layers):
+        # [batch, length, emb_dim] -> [batch, length, emb_dim]
+        # Arguments are passed positionally for `static_argnums` of remat.
+        y = BlockLayer(
+            config=cfg, name=f'layers_{lyr}')(
+                y, encoded, decoder_mask, encoder_decoder_mask, deterministic,
+                decode, max_decode_length, decoder_bias)
 
     y = layers.LayerNorm(dtype=cfg.dtype, name='decoder_norm')(y)
     y = nn.Dropout(
@@ -262,14 +401,18 @@ class Decoder(nn.Module):
     # [batch, length, emb_dim] -> [batch, length, vocab_size]
     if cfg.logits_via_embedding:
       # Use the transpose of embedding matrix for logit transform.
-      logits = self.shared_embedding.attend(y)
+      logits = self.shared_embedding.attend(
+          y, preferred_element_type=jnp.float32)
       # Correctly normalize pre-softmax logits for this shared case.
       logits = logits / jnp.sqrt(y.shape[-1])
     else:
       logits = layers.DenseGeneral(
           cfg.vocab_size,
-          dtype=jnp.float32,  # Use float32 for stabiliity.
+          # The logits are always accumulated in float32 for stability, even
+          # when the operands are kept in `dtype`.
+          dtype=jnp.float32 if cfg.float32_logits_matmul else cfg.dtype,
           kernel_axes=('embed', 'vocab'),
+          preferred_element_type=jnp.float32,
           name='logits_dense')(
               y)
     return logits
@@ -278,6 +421,14 @@ class Decoder(nn.Module):
 class Transformer(nn.Module):
   """An encoder-decoder Transformer model."""
   config: T5Config
+  # needed only for janky models.py scan_layers detection.
+  scan_layers: bool = struct.field(init=False)
+
+  def __post_init__(self):
+    super().__post_init__()
+    # needed only for janky models.py scan_layers detection.
+    object.__setattr__(self, 'scan_layers',
+                       object.__getattribute__(self, 'config').scan_layers)
 
   def setup(self):
     cfg = self.config
@@ -285,9 +436,10 @@ class Transformer(nn.Module):
         num_embeddings=cfg.vocab_size,
         features=cfg.emb_dim,
         dtype=cfg.dtype,
-        attend_dtype=jnp.float32,  # for logit training stability
+        # for logit training stability
+        attend_dtype=jnp.float32 if cfg.float32_logits_matmul else cfg.dtype,
         embedding_init=nn.initializers.normal(stddev=1.0),
-        one_hot=True,
+        one_hot=cfg.embed_one_hot,
         name='token_embedder')
 
     self.encoder = Encoder(config=cfg, shared_embedding=self.shared_embedding)
@@ -303,9 +455,11 @@ class Transformer(nn.Module):
         f'Expected `encoder_input_tokens` to be of shape (batch, len). '
         f'Got {encoder_input_tokens.shape}')
 
-    # Make padding attention mask.
+    # Make padding attention mask. Masks are kept boolean, which is the
+    # smallest representation, and only turned into biases by the attention.
+    encoder_padding = encoder_input_tokens > 0
     encoder_mask = layers.make_attention_mask(
-        encoder_input_tokens > 0, encoder_input_tokens > 0, dtype=cfg.dtype)
+        encoder_padding, encoder_padding, dtype=jnp.bool_)
     # Add segmentation block-diagonal attention mask if using segmented data.
     if encoder_segment_ids is not None:
       encoder_mask = layers.combine_masks(
@@ -314,7 +468,8 @@ class Transformer(nn.Module):
               encoder_segment_ids,
               encoder_segment_ids,
               jnp.equal,
-              dtype=cfg.dtype))
+              dtype=jnp.bool_),
+          dtype=jnp.bool_)
 
     return self.encoder(
         encoder_input_tokens, encoder_mask, deterministic=not enable_dropout)
@@ -333,6 +488,7 @@ class Transformer(nn.Module):
       max_decode_length=None):
     """Applies Transformer decoder-branch on encoded-input and target."""
     cfg = self.config
+    encoder_padding = encoder_input_tokens > 0
 
     # Make padding attention masks.
     if decode:
@@ -341,15 +497,15 @@ class Transformer(nn.Module):
       decoder_mask = None
       encoder_decoder_mask = layers.make_attention_mask(
           jnp.ones_like(decoder_target_tokens),
-          encoder_input_tokens > 0,
-          dtype=cfg.dtype)
+          encoder_padding,
+          dtype=jnp.bool_)
     else:
       decoder_mask = layers.make_decoder_mask(
           decoder_target_tokens=decoder_target_tokens,
-          dtype=cfg.dtype,
+          dtype=jnp.bool_,
           decoder_segment_ids=decoder_segment_ids)
       encoder_decoder_mask = layers.make_attention_mask(
-          decoder_target_tokens > 0, encoder_input_tokens > 0, dtype=cfg.dtype)
+          decoder_target_tokens > 0, encoder_padding, dtype=jnp.bool_)
 
     # Add segmentation block-diagonal attention masks if using segmented data.
     if encoder_segment_ids is not None:
@@ -364,7 +520,8 @@ class Transformer(nn.Module):
               decoder_segment_ids,
               encoder_segment_ids,
               jnp.equal,
-              dtype=cfg.dtype))
+              dtype=jnp.bool_),
+          dtype=jnp.bool_)
 
     logits = self.decoder(
         encoded,
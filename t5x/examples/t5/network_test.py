@@ -15,16 +15,20 @@
 """Tests for network."""
 
 import os
+from unittest import mock
 
 from absl import flags
 from absl.testing import absltest
 from absl.testing import parameterized
+import flax
 import jax
+import jax.numpy as jnp
 import numpy as np
 import seqio
 from t5x import adafactor
 from t5x import models
 from t5x import test_utils
+from t5x.examples.t5 import layers
 from t5x.examples.t5 import network
 
 # Parse absl flags test_srcdir and test_tmpdir.
@@ -40,7 +44,8 @@ def get_test_model(emb_dim,
                    dtype='float32',
                    vocab_size=32128,
                    num_encoder_layers=2,
-                   num_decoder_layers=2):
+                   num_decoder_layers=2,
+                   **config_kwargs):
   config = network.T5Config(
       num_encoder_layers=num_encoder_layers,
       num_decoder_layers=num_decoder_layers,
@@ -51,7 +56,8 @@ def get_test_model(emb_dim,
       head_dim=head_dim,
       mlp_dim=mlp_dim,
       dtype=dtype,
-      mlp_activations=('gelu', 'linear'))
+      mlp_activations=('gelu', 'linear'),
+      **config_kwargs)
   module = network.Transformer(config=config)
   vocab = seqio.test_utils.sentencepiece_vocab()
   optimizer_def = adafactor.Adafactor()
@@ -107,6 +113,141 @@ class NetworkTest(parameterized.TestCase):
         scores['scores'], [-3.040324, -1.928565], rtol=1e-2
     )
 
+  def test_packed_attention_masks_are_boolean(self):
+    model = get_test_model(
+        emb_dim=13, head_dim=16, num_heads=4, mlp_dim=32, vocab_size=10)
+    params = model.get_initial_variables(
+        jax.random.PRNGKey(0), self.input_shapes)['params']
+    batch_size = self.batch['encoder_input_tokens'].shape[0]
+
+    mask_dtypes = []
+    combine_masks = layers.combine_masks
+
+    def recording_combine_masks(*masks, **kwargs):
+      mask = combine_masks(*masks, **kwargs)
+      mask_dtypes.append(mask.dtype)
+      return mask
+
+    with mock.patch.object(layers, 'combine_masks', recording_combine_masks):
+      model.module.apply(
+          {'params': params},
+          self.batch['encoder_input_tokens'],
+          self.batch['decoder_input_tokens'],
+          self.batch['decoder_target_tokens'],
+          encoder_segment_ids=np.array([[1, 1, 2, 2]] * batch_size),
+          decoder_segment_ids=np.array([[1, 2, 2]] * batch_size),
+          enable_dropout=False)
+    # Encoder mask, decoder mask and encoder-decoder mask.
+    self.assertLen(mask_dtypes, 3)
+    self.assertEqual(set(mask_dtypes), {jnp.dtype(jnp.bool_)})
+
+  def test_scan_layers_matches_unrolled(self):
+    model = get_test_model(
+        emb_dim=13, head_dim=16, num_heads=4, mlp_dim=32, vocab_size=10)
+    scanned_model = get_test_model(
+        emb_dim=13,
+        head_dim=16,
+        num_heads=4,
+        mlp_dim=32,
+        vocab_size=10,
+        scan_layers=True)
+    params = model.get_initial_variables(
+        jax.random.PRNGKey(0), self.input_shapes)['params']
+
+    # Stack the unrolled per-layer parameters along a leading 'layers' axis.
+    scanned_params = flax.core.unfreeze(params)
+    for stack in ('encoder', 'decoder'):
+      layer_params = [
+          scanned_params[stack].pop(f'layers_{lyr}') for lyr in range(2)
+      ]
+      scanned_params[stack]['layers'] = jax.tree_util.tree_map(
+          lambda *xs: np.stack(xs), *layer_params)
+
+    loss, _ = jax.jit(model.loss_fn)(params, self.batch, None)
+    scanned_loss, _ = jax.jit(scanned_model.loss_fn)(
+        flax.core.freeze(scanned_params), self.batch, None)
+    np.testing.assert_allclose(scanned_loss, loss, rtol=1e-5)
+
+    predicted, _ = model.predict_batch_with_aux(params, self.batch)
+    scanned_predicted, _ = scanned_model.predict_batch_with_aux(
+        flax.core.freeze(scanned_params), self.batch)
+    np.testing.assert_array_equal(scanned_predicted, predicted)
+
+  @parameterized.parameters(
+      {'scan_layers': False},
+      {'scan_layers': True},
+  )
+  def test_remat_matches_no_remat(self, scan_layers):
+    # Parameters are shared between both models, so both scan or both unroll.
+    model = get_test_model(
+        emb_dim=13,
+        head_dim=16,
+        num_heads=4,
+        mlp_dim=32,
+        vocab_size=10,
+        scan_layers=scan_layers)
+    remat_model = get_test_model(
+        emb_dim=13,
+        head_dim=16,
+        num_heads=4,
+        mlp_dim=32,
+        vocab_size=10,
+        scan_layers=scan_layers,
+        remat_policy='dots_with_no_batch_dims_saveable')
+    params = model.get_initial_variables(
+        jax.random.PRNGKey(0), self.input_shapes)['params']
+
+    def grad_fn(m):
+      return jax.jit(jax.grad(lambda p: m.loss_fn(p, self.batch, None)[0]))
+
+    grads = grad_fn(model)(params)
+    remat_grads = grad_fn(remat_model)(params)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-6),
+        grads, remat_grads)
+
+  @parameterized.parameters(
+      {'logits_via_embedding': False},
+      {'logits_via_embedding': True},
+  )
+  def test_bfloat16_logits_matmul_matches_float32(self, logits_via_embedding):
+    kwargs = dict(
+        emb_dim=13,
+        head_dim=16,
+        num_heads=4,
+        mlp_dim=32,
+        vocab_size=10,
+        dtype='bfloat16',
+        logits_via_embedding=logits_via_embedding)
+    model = get_test_model(**kwargs)
+    bf16_model = get_test_model(float32_logits_matmul=False, **kwargs)
+    params = model.get_initial_variables(
+        jax.random.PRNGKey(0), self.input_shapes)['params']
+
+    loss, _ = jax.jit(model.loss_fn)(params, self.batch, None)
+    bf16_loss, _ = jax.jit(bf16_model.loss_fn)(params, self.batch, None)
+    np.testing.assert_allclose(bf16_loss, loss, rtol=1e-2)
+
+    logits = bf16_model.module.apply(
+        {'params': params},
+        self.batch['encoder_input_tokens'],
+        self.batch['decoder_input_tokens'],
+        self.batch['decoder_target_tokens'],
+        enable_dropout=False)
+    self.assertEqual(logits.dtype, jnp.float32)
+
+  @parameterized.parameters('save_only_these_names', 'not_a_policy')
+  def test_invalid_remat_policy_raises(self, remat_policy):
+    model = get_test_model(
+        emb_dim=13,
+        head_dim=16,
+        num_heads=4,
+        mlp_dim=32,
+        vocab_size=10,
+        remat_policy=remat_policy)
+    with self.assertRaisesRegex(ValueError, 'Unknown remat_policy'):
+      model.get_initial_variables(jax.random.PRNGKey(0), self.input_shapes)
+
 
 if __name__ == '__main__':
   absltest.main()